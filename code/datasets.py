@@ -713,18 +713,22 @@ class TCGADataHandler():
                 num_workers=0
         )
 
-    def by_type(self, batch_size, select_size=-1, dataset="pretrain", reps=1):
+    def by_type(self, batch_size, select_size=-1, dataset="pretrain", reps=1, rand=None):
+        # rand picks the types and orders each type's samples; pass a seeded
+        # Random for the same batches across processes
+        gen = None if rand is None else torch.Generator().manual_seed(rand.getrandbits(63))
+        rand = random if rand is None else rand
         for _ in range(reps):
             if select_size == -1:
                 types = range(self.num_types)
             else:
                 types = list(range(self.num_types))
-                random.shuffle(types)
+                rand.shuffle(types)
                 types = types[:select_size]
             
             for i in types:
                 type_idx = torch.arange(0, len(self._dataset))[self._dataset[:]["type"] == i]
-                shuffle_idx = torch.randperm(torch.numel(type_idx))
+                shuffle_idx = torch.randperm(torch.numel(type_idx), generator=gen)
                 type_idx = type_idx[shuffle_idx]
                 if dataset == "pretrain":
                     type_idx = np.intersect1d(type_idx, self._c_pretrain_idx)
@@ -806,47 +810,77 @@ class TCGADataHandler():
             return None, None, dataset
         
         mods = list(dataset.keys())
-        size = dataset[mods[0]]
-        if isinstance(size, dict):
-            size = size[list(size.keys())[0]]
-        size = size.size()[0]
-
-        perm_idx = torch.randperm(size)
-        lam = torch.unsqueeze(torch.Tensor(np.random.exponential(scale=scale, size=size)), dim=1)
-        lam = torch.minimum(lam, torch.full(lam.size(), 1.0)).cuda()
+        first = dataset[mods[0]]
+        if isinstance(first, dict):
+            first = first[list(first.keys())[0]]
+        size = first.size()[0]
+
+        # drawn where the batch lives, so no index or mask goes through the host.
+        # lam ~ min(Exp(mean=scale), 1), as before
+        device = first.device if first.is_cuda else torch.device('cuda')
+        perm_idx = torch.randperm(size, device=device)
+        lam = torch.empty((size, 1), device=device).exponential_(1 / scale).clamp_(max=1.0)
         for m in ['rna-seq']:
             if isinstance(dataset[m], dict):
                 if list(sorted(dataset[m].keys())) == sorted(["input_ids", "attention_mask"]):
-                    do_mixup = torch.rand(dataset[m]["input_ids"].size()).cuda() < lam
-                    dataset[m]["input_ids"][do_mixup] = dataset[m]["input_ids"][perm_idx, :][do_mixup]
-                    dataset[m]["input_ids"] = dataset[m]["input_ids"] * dataset[m]["attention_mask"]
+                    input_ids = dataset[m]["input_ids"]
+                    do_mixup = torch.rand(input_ids.size(), device=device) < lam
+                    input_ids[do_mixup] = input_ids.index_select(0, perm_idx)[do_mixup]
+                    dataset[m]["input_ids"] = input_ids * dataset[m]["attention_mask"]
                 elif list(sorted(dataset[m].keys())) == sorted(["continuous", "categorical"]):
-                    do_mixup = torch.rand(dataset[m]["categorical"].size()).cuda() < lam
-                    dataset[m]["categorical"][do_mixup] = dataset[m]["categorical"][perm_idx, :][do_mixup]
-                    do_mixup = torch.rand(dataset[m]["continuous"].size()).cuda() < lam
-                    dataset[m]["continuous"] = dataset[m]["continuous"] * (1 - lam) + dataset[m]["continuous"][perm_idx, :] * lam
+                    categorical = dataset[m]["categorical"]
+                    do_mixup = torch.rand(categorical.size(), device=device) < lam
+                    categorical[do_mixup] = categorical.index_select(0, perm_idx)[do_mixup]
+                    continuous = dataset[m]["continuous"]
+                    dataset[m]["continuous"] = torch.lerp(continuous, continuous.index_select(0, perm_idx), lam)
                 elif torch.is_tensor(dataset[m]):
-                    dataset[m] = dataset[m] * (1 - lam) + dataset[m][perm_idx, :] * lam
+                    dataset[m] = torch.lerp(dataset[m], dataset[m].index_select(0, perm_idx), lam)
 
-        return perm_idx.cuda(), lam, dataset
+        return perm_idx, lam, dataset
 
 class SiteSampler(torch.utils.data.sampler.Sampler):
     def __init__(self, dataset, num_matches=2):
         self.ids = dataset[:]["id"]
         self.num_matches = num_matches
 
-    def __iter__(self):
-        shuffle_ids = site_shuffle(self.ids, random.Random())
+    def _order(self, rand, np_rand):
+        shuffle_ids = site_shuffle(self.ids, rand)
         ret = [self.ids.index(x) for x in shuffle_ids]
         ret = ret[:self.num_matches * floor(len(ret) / self.num_matches)]
         ret = np.reshape(np.array(ret), (-1, self.num_matches))
-        np.random.shuffle(ret)
-        ret = list(np.reshape(ret, (-1, )))
-        return iter(ret)
+        np_rand.shuffle(ret)
+        return list(np.reshape(ret, (-1, )))
+
+    def __iter__(self):
+        return iter(self._order(random.Random(), np.random))
 
     def __len__(self):
         return len(self.ids)
 
+class DistributedSiteSampler(SiteSampler):
+    # every rank draws the same SiteSampler order (seeded by the epoch), then
+    # takes every num_replicas-th batch of it, so site matches stay together
+    # inside a batch and all ranks get the same number of batches
+    def __init__(self, dataset, batch_size, num_replicas, rank, num_matches=2):
+        super().__init__(dataset, num_matches=num_matches)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        ret = self._order(random.Random(self.epoch), np.random.RandomState(self.epoch))
+        batches = [ret[i:i + self.batch_size] for i in range(0, len(ret), self.batch_size)]
+        batches = batches[:len(self) // self.batch_size * self.num_replicas]
+        return iter([x for b in batches[self.rank::self.num_replicas] for x in b])
+
+    def __len__(self):
+        num = self.num_matches * floor(len(self.ids) / self.num_matches)
+        return num // (self.batch_size * self.num_replicas) * self.batch_size
+
 # A universal TCGA dataset generator.
 class TCGADataset(torch.utils.data.Dataset):
     def __init__(self, data_src, save=True, copy_ds=None, rna_thresh=0.5, clin_thresh=50, rna_set='', lm_arch='distilbert', clin_one_hot=False): 
@@ -1,3 +1,4 @@
+import ast
 import glob
 import random
 from lifelines import CoxPHFitter
@@ -89,7 +90,7 @@ def string_to_list(inn):
     if not inn.endswith("]"):
         inn = inn + '"]'
 
-    return eval(inn)
+    return ast.literal_eval(inn)
 
 def nandiv(a, b):
     if b != 0:
@@ -1,3 +1,4 @@
+import os
 import torch
 import transformers
 import model
@@ -26,18 +27,27 @@ def most_recent_file(folder, ext=""):
 
     return max_file
 
+def saved_args_path(folder, num):
+    # as in train.py: args are only rewritten when they change, so epoch num's
+    # args are the newest .args at or before it
+    for e in range(num, -1, -1):
+        path = os.path.join(folder, str(e) + ".args")
+        if os.path.isfile(path):
+            return path
+    return os.path.join(folder, str(num) + ".args")
+
 def load_dataset_and_model(path_dir, num=-1):
     global g_dataset, g_encoder, g_lr, g_mode
 
     if num == -1:
         print("fetching most recent model (CTRL+C if this isn't what you want!")
-        file_cand = most_recent_file("../save/" + path_dir) 
-        num = file_cand[file_cand.rfind("/"):file_cand.rfind(".")]
+        file_cand = most_recent_file("../save/" + path_dir, (".args", ".epoch"))
+        num = file_cand[file_cand.rfind("/") + 1:file_cand.rfind(".")]
         num = int(num)
         print("num is", num)
         input("confirm")
 
-    with open("../save/" + path_dir + "/" + str(num) + ".args") as f:
+    with open(saved_args_path("../save/" + path_dir, num)) as f:
         args = json.load(f)
     if args["mode"] == "validate":
         dataset = datasets.TCGADataset(lr_data=[args["left"]], target=args["target"])
@@ -1,70 +1,197 @@
+import asyncio
+import fcntl
+import logging
+import logging.handlers
+import mmap
+import os
+import queue
+import re
+import shlex
+import shutil
+import signal
 import subprocess
-import time
-import traceback
-import multiprocessing
+import sys
 
 # run script for hyperparameter tuning
 
-def run_line(cmd, gpu):
-    if gpu == 0:
+GPU_GROUPS = ["0,1,2,3", "4,5,6,7"]
+GPU_ARGS = {gpu: ['--new_weights', '--gpu=' + gpu] for gpu in GPU_GROUPS}
+# per-job wall-clock budget in seconds (None for no limit); on timeout the
+# job gets SIGTERM, then SIGKILL after the grace period
+MAX_JOB_SECONDS = None
+KILL_GRACE_SECONDS = 30
+# gpu_cpusets maps ordinals in nvidia-smi's PCI order, so the jobs' cuda
+# ordinals (--gpu) must follow the same order rather than FASTEST_FIRST
+JOB_ENV = dict(os.environ, CUDA_DEVICE_ORDER="PCI_BUS_ID")
+# jobs run unpinned where taskset isn't installed
+TASKSET = shutil.which("taskset")
+_PATH_DIR_RE = re.compile(r'--path_dir[=\s]+(\S+)')
+
+# run_line only enqueues; a QueueListener thread writes rs_log.txt (and
+# errors to stderr)
+_log_q = queue.Queue()
+logger = logging.getLogger("run_script")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(_log_q))
+
+def parse_cpulist(cpulist):
+    # "0-15,32-47" -> {0, ..., 15, 32, ..., 47}
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        lo, _, hi = part.partition("-")
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def gpu_cpusets(groups=GPU_GROUPS):
+    # cpus local to each gpu group's NUMA node(s), or None if unknown
+    try:
+        bus_ids = subprocess.run(["nvidia-smi", "--query-gpu=pci.bus_id", "--format=csv,noheader"],
+                capture_output=True, text=True, check=True).stdout.split()
+        local = []
+        for bus_id in bus_ids:
+            with open(f"/sys/bus/pci/devices/{bus_id[-12:].lower()}/local_cpulist", "r") as f:
+                local.append(parse_cpulist(f.read()))
+        allowed = os.sched_getaffinity(0)
+        return {group: set.union(*(local[int(g)] for g in group.split(","))) & allowed or None for group in groups}
+    except (OSError, ValueError, IndexError, subprocess.CalledProcessError):
+        return {group: None for group in groups}
+
+def gpu_lock_path(gpu_range):
+    return "/tmp/conred_gpu" + gpu_range.replace(",", "") + ".lock"
+
+async def run_line(cmd, gpu_range, cpuset=None):
+    # returns whether the line can be commented out; main() owns run_lines.txt
+    logger.info(f"running {cmd} gpus {gpu_range}")
+    argv = shlex.split(cmd) + GPU_ARGS[gpu_range]
+    if argv[0] == "python":
+        argv[0] = sys.executable
+    if cpuset and TASKSET:
+        # taskset pins before exec, so every thread and worker the job starts
+        # inherits it; no python runs in the forked child
+        argv = [TASKSET, "-c", ",".join(str(c) for c in sorted(cpuset))] + argv
+    # flock is held for the job's lifetime, so a second copy of this script
+    # waits for the group instead of training on the same gpus
+    with open(gpu_lock_path(gpu_range), "w") as lock:
+        await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+        # own session, so a timeout can stop the job's mp.spawn workers with it
+        proc = await asyncio.create_subprocess_exec(*argv, close_fds=False, start_new_session=True, env=JOB_ENV)
         try:
-            with open("rs_log.txt", "a") as f:
-                f.write(f"running {cmd} gpus 0-3\n")
-            subprocess.run(cmd + ' --new_weights --gpu=0,1,2,3', shell=True)
-            clear(cmd)
-        except:
-            print(traceback.format_exc())
+            await asyncio.wait_for(proc.wait(), timeout=MAX_JOB_SECONDS)
+        except asyncio.CancelledError:
+            # the job's own session doesn't get the sweep's ctrl-c, so stop it
+            # here, before the flock is released for the next sweep
+            await stop_job(proc)
+            raise
+        except asyncio.TimeoutError:
+            await stop_job(proc)
+            # left uncommented in run_lines.txt so a later sweep retries it
+            logger.info(f"timed out {cmd} gpus {gpu_range}")
+            with open("rs_timeouts.txt", "a") as f:
+                f.write(cmd + "\n")
+            return False
+    # scanning all.log blocks, so keep it off the loop the other group dispatches from
+    return await asyncio.to_thread(training_complete, cmd)
+
+def signal_job(proc, sig):
+    # the whole process group, since the ddp workers would otherwise keep the gpus
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+async def stop_job(proc):
+    signal_job(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        signal_job(proc, signal.SIGKILL)
+        await proc.wait()
     else:
+        # the leader exited, but workers that ignored SIGTERM may still be up
+        signal_job(proc, signal.SIGKILL)
+
+def training_complete(cmd):
+    m = _PATH_DIR_RE.search(cmd)
+    if m is None:
+        return True
+    path_dir = m.group(1).strip("'\"")
+
+    # train.py logs to ../save/<path_dir>/all.log relative to this directory.
+    # the marker is near the end, so search backwards through a mmap rather
+    # than reading a log that can run to hundreds of MB
+    try:
+        with open("../save/" + path_dir + "/all.log", "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m.rfind(b"Training complete") == -1:
+                    return False
+    except FileNotFoundError:
+        return False
+    print(cmd, "clearing this")
+    return True
+
+def clear(lines, cmd):
+    # comments out cmd in the cached lines, returns whether anything changed
+    changed = False
+    for it, line in enumerate(lines):
+        if line == cmd:
+            lines[it] = "# " + line
+            changed = True
+    return changed
+
+def write_lines(lines, path="run_lines.txt"):
+    # write then rename, so a crash mid-write can't truncate the sweep state
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    os.replace(tmp, path)
+
+async def gpu_worker(gpu_range, cpuset, line_q, lines):
+    # one per gpu group; takes the next line as soon as its last job exits
+    while True:
+        cmd = await line_q.get()
         try:
-            with open("rs_log.txt", "a") as f:
-                f.write(f"running {cmd} gpus 4-7\n")
-            subprocess.run(cmd + ' --new_weights --gpu=4,5,6,7', shell=True)
-            clear(cmd)
-        except:
-            print(traceback.format_exc())
-
-def clear(cmd):
-    lines = []
-    for x in cmd:
-        if "--path_dir" in x:
-            with open("../../save/" + x[x.rfind("=") + 1:] + "/all.log", "r") as f:
-                y = f.read()
-                if "Training complete" not in y:
-                    return
-                else:
-                    print(cmd, "clearing this")
+            if await run_line(cmd, gpu_range, cpuset) and clear(lines, cmd):
+                write_lines(lines)
+        except Exception:
+            logger.exception("job failed: %s", cmd)
+        finally:
+            line_q.task_done()
 
+async def main():
+    # read once; only this process rewrites run_lines.txt from here on
+    lines = []
+    line_q = asyncio.Queue()
     with open("run_lines.txt", "r") as f:
-        ls = f.read().split("\n")
-        for line in ls:
-            if len(line) == 0 or line[0] == "#":
-                lines.append(line)
-            elif line == cmd:
-                lines.append("# " + line)
-            else:
-                lines.append(line)
-        with open("run_lines_save.txt", "w") as g:
-            for l in ls:
-                g.write(l + "\n")
-    
-    with open("run_lines.txt", "w") as f:
-        for line in lines:
-            f.write(line + "\n")
-
-with open("run_lines.txt", "r") as f:
-    ls = f.read().split("\n")
-    previous_run = None
-    for line in ls:
-        if len(line) == 0 or line[0] == "#":
-            continue
-
-        if previous_run == None:
-            p = multiprocessing.Process(target=run_line, args=(line,0))
-            p.start()
-            previous_run = p
-        else:
-            p = multiprocessing.Process(target=run_line, args=(line,1))
-            p.start()
-            previous_run.join()
-            p.join()
-            previous_run = None
+        for raw in f:
+            line = raw.rstrip("\n")
+            lines.append(line)
+            if not line or line.startswith("#"):
+                continue
+            line_q.put_nowait(line)
+    write_lines(lines, "run_lines_save.txt")
+
+    cpusets = gpu_cpusets()
+    workers = [asyncio.create_task(gpu_worker(gpu, cpusets[gpu], line_q, lines)) for gpu in GPU_GROUPS]
+    # SIGTERM to the sweep cancels it like ctrl-c, so running jobs are stopped
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await line_q.join()
+    finally:
+        # on cancel too: each worker stops its running job on the way out
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+if __name__ == '__main__':
+    # failures also go to the terminal, as the old traceback prints did
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setLevel(logging.ERROR)
+    listener = logging.handlers.QueueListener(_log_q, logging.FileHandler("rs_log.txt"), stderr_handler, respect_handler_level=True)
+    listener.start()
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
@@ -1,7 +1,10 @@
 # python imports
 import os
+import ast
 import gc
-import subprocess
+import math
+import atexit
+import socket
 import traceback
 import argparse
 import datetime
@@ -14,9 +17,10 @@ import pickle
 import json
 from copy import deepcopy
 from itertools import chain
-from sklearn.linear_model import LogisticRegression
+from contextlib import ExitStack
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # sci suite
 import statistics
@@ -25,9 +29,6 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.special import ellipj
 from scipy import stats
-import sklearn
-from sklearn import ensemble
-from sklearn import multioutput
 from sklearn.metrics import roc_auc_score
 
 # torch
@@ -35,6 +36,7 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 import torch.distributed as dist
+import torch.distributed.nn
 import torch.optim as optim
 import torch.multiprocessing as mp
 import torchvision
@@ -46,20 +48,28 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 import datasets 
 import model
 from tabtransformer.tabtransformer.tab_transformer_pytorch import CombTabTransformer
-from sync_batchnorm.sync_batchnorm import convert_model
 
 verbose = False
 
 def most_recent_file(folder, ext=""):
+    # scandir entries carry their type, so only files matching ext get a stat
     max_time = 0
     max_file = ""
-    for dirname, subdirs, files in os.walk(folder):
-        for fname in files:
-            full_path = os.path.join(dirname, fname)
-            time = os.stat(full_path).st_mtime
-            if time > max_time and full_path.endswith(ext):
-                max_time = time
-                max_file = full_path
+    dirs = [folder]
+    while dirs:
+        dirname = dirs.pop(0)
+        subdirs = []
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                # no symlink following, as with the os.walk this replaced
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and entry.name.endswith(ext):
+                    time = entry.stat().st_mtime
+                    if time > max_time:
+                        max_time = time
+                        max_file = entry.path
+        dirs = subdirs + dirs
 
     return max_file
 
@@ -76,77 +86,57 @@ def string_to_list(inn):
     if not inn.endswith("]"):
         inn = inn + '"]'
 
-    return eval(inn)
+    return ast.literal_eval(inn)
 
 def int_splitter(floats, my_sum):
-    try:
-        assert(abs(1 - sum(floats)) < 0.01)
-    except:
+    if not math.isclose(sum(floats), 1.0, abs_tol=0.01):
         raise ValueError("splits must sum to 1!")
-    orig_sum = my_sum
-
-    tot_size = 0
-    ret = [int(floats[0] * my_sum)]
-    tot_size += ret[0]
 
-    for i in range(1, len(floats) - 1):
-        floats.pop(0)
-        ret.append(int(floats[0]  * orig_sum))
-        tot_size += ret[-1]
-    ret.append(orig_sum - tot_size)
+    # floor every split but the last, which takes the remainder
+    ret = np.floor(np.array(floats) * my_sum).astype(int)
+    ret[-1] = my_sum - ret[:-1].sum()
 
-    return ret
+    return ret.tolist()
 
 log_file = None
+_log_fp = None
 def pwint(*args, sep=None):
     # printsand writes at the sametime
+    global _log_fp
     print(*args)
     args = [str(x) for x in args]
     if sep == None:
         sep = " "
     args = sep.join(args)
-    with open(log_file, 'a') as f:
-        f.write(args + "\n")
-
-class LRScheduler(object):
+    if _log_fp is None:
+        # opened once on first use and line buffered: the ddp parent and rank 0
+        # both append, and a job killed on timeout never runs atexit
+        _log_fp = open(log_file, 'a', buffering=1)
+        atexit.register(_log_fp.close)
+    _log_fp.write(args + "\n")
+
+def build_lr_table(warmup_epochs, warmup_lr, num_epochs, base_lr, final_lr, iter_per_epoch, flat_warmup=False):
     """
-    Learning rate scheduler for the optimizer.
+    Per-step learning rates for the whole run, as float32.
 
     Warmup increases to base linearly, while base decays to final using cosine.
     """
+    warmup_iter = iter_per_epoch * warmup_epochs
+    if not flat_warmup:
+        warmup_lr_schedule = np.linspace(warmup_lr, base_lr, warmup_iter)
+    else:
+        warmup_lr_schedule = np.linspace(warmup_lr, warmup_lr, warmup_iter)
+    decay_iter = iter_per_epoch * (num_epochs - warmup_epochs)
+    cosine_lr_schedule = final_lr + 0.5 * (base_lr - final_lr) * (
+            1 + np.cos(np.pi * np.arange(decay_iter) / decay_iter))
 
-    def __init__(self, optimizer, warmup_epochs, warmup_lr, num_epochs, base_lr, final_lr, iter_per_epoch,
-                 constant_predictor_lr=False, flat_warmup=False):
-        self.base_lr = base_lr
-        self.constant_predictor_lr = constant_predictor_lr
-        warmup_iter = iter_per_epoch * warmup_epochs
-        if not flat_warmup:
-            warmup_lr_schedule = np.linspace(warmup_lr, base_lr, warmup_iter)
-        else:
-            warmup_lr_schedule = np.linspace(warmup_lr, warmup_lr, warmup_iter)
-        decay_iter = iter_per_epoch * (num_epochs - warmup_epochs)
-        cosine_lr_schedule = final_lr + 0.5 * (base_lr - final_lr) * (
-                1 + np.cos(np.pi * np.arange(decay_iter) / decay_iter))
-
-        self.lr_schedule = np.concatenate((warmup_lr_schedule, cosine_lr_schedule))
-        self.optimizer = optimizer
-        self.iter = 0
-        self.current_lr = 0
-
-    def step(self):
-        for param_group in self.optimizer.param_groups:
-            lr = param_group['lr'] = self.lr_schedule[self.iter]
-
-        self.iter += 1
-        self.current_lr = lr
-        return lr
-
-    def get_lr(self):
-        return self.current_lr
+    return np.concatenate((warmup_lr_schedule, cosine_lr_schedule)).astype(np.float32)
 
 def euclidean_dist(z1, z2):
-    n = z1.shape[0]
-    return 2 * z1 @ z2.T - torch.diagonal(z1 @ z1.T).repeat(n).reshape((n,n)).T - torch.diagonal(z2 @ z2.T).repeat(n).reshape((n,n))
+    # negative squared distances, -|z1_i - z2_j|^2, from row norms and one matmul
+    sq1 = (z1 * z1).sum(1, keepdim=True)
+    sq2 = (z2 * z2).sum(1, keepdim=True)
+    return 2 * z1 @ z2.T - sq1 - sq2.T
 
 def simsiam_loss(p, z, distance="cosine"):
     """
@@ -159,11 +149,11 @@ def simsiam_loss(p, z, distance="cosine"):
     :return: -cosine_similarity(p, z)
     """
     if distance == "euclidean":
-        return - torch.diagonal(euclidean_dist(p, z.detach())).mean()
+        return (p - z.detach()).pow(2).sum(1).mean()
     elif distance == "cosine":
         return - F.cosine_similarity(p, z.detach(), dim=-1).mean()
 
-def _uni_info_nce(z1, z2, temperature=0.1, distance="cosine", both_sides=True, remove_duplicates=False, targets=None, lam=None, perm_idx=None):
+def _uni_info_nce(z1, z2, temperature=0.1, distance="cosine", both_sides=True, remove_duplicates=False, targets=None, lam=None, perm_idx=None, pre_normalized=False, labels=None):
     """
     Noise contrastive estimation loss.
     Contrastive learning loss with *both* positive and negative terms.
@@ -171,89 +161,130 @@ def _uni_info_nce(z1, z2, temperature=0.1, distance="cosine", both_sides=True, r
     :param z1: first vector
     :param z2: second vector
     :param temperature: how sharp the prediction task is
-    :param both_sides: whether to use both-sided infoNCE
+    :param both_sides: whether to use both-sided (symmetric, CLIP-style) infoNCE
+    :param pre_normalized: z1 and z2 are already unit-norm (cosine only)
+    :param labels: prebuilt arange(n) on the logits' device, ignored with targets
     :return: infoNCE(z1, z2)
     """
     if z1.size()[1] <= 1 and distance == "cosine":
         raise UserWarning('InfoNCE loss has only one dimension, add more dimensions')
     if remove_duplicates and targets != None:
         raise ValueError("don't do both remove duplicates & targets for clip acc")
+    if both_sides and (remove_duplicates or targets != None):
+        raise ValueError("both-sided infoNCE needs one-to-one pairs, don't use remove duplicates or targets")
 
     if remove_duplicates:
-        z2_ = torch.unique(z2, dim=0)
-        map_idx = [-1000] * len(z2)
-        for i in range(len(z2_)):
-            mask = [torch.equal(x, z2_[i]) for x in z2]
-            mask = [it for it, elem in enumerate(mask) if elem]
-            for m in mask:
-                map_idx[m] = i
-        z2 = deepcopy(z2_.detach())
-
-    if both_sides:
-        combined = torch.cat((z1, z2))
-        z1 = combined
-        z2 = combined
+        # map_idx[i] is the row of the deduplicated z2 equal to z2[i];
+        # unique already returns a fresh tensor, so no copy is needed
+        z2, map_idx = torch.unique(z2, dim=0, return_inverse=True)
+        z2 = z2.detach()
 
     if distance == "cosine":
-        z1 = torch.nn.functional.normalize(z1, dim=1)
-        z2 = torch.nn.functional.normalize(z2, dim=1)
+        if not pre_normalized:
+            z1 = torch.nn.functional.normalize(z1, dim=1)
+            z2 = torch.nn.functional.normalize(z2, dim=1)
         logits = z1 @ z2.T
     elif distance == "euclidean":
         logits = euclidean_dist(z1, z2)
 
     logits /= temperature
-    if torch.cuda.is_available(): # TODO: add projectors, also make it symmetric
+    if torch.cuda.is_available(): # TODO: add projectors
         logits = logits.cuda()
 
-    if both_sides:
-        n = z1.shape[0] // 2
-    else:
-        n = z1.shape[0]
+    n = z1.shape[0]
     if targets != None:
-        labels = targets
-    elif both_sides:
-        labels = torch.arange(0, 2 * n, dtype=torch.long)
-        labels[:n] = labels[:n] + n
-        labels[n:] = labels[n:] - n
-        labels = labels.tolist()
-    else:
-        labels = torch.arange(0, n, dtype=torch.long).tolist()
+        labels = torch.as_tensor(targets, dtype=torch.long, device=logits.device)
+    elif labels is None:
+        labels = torch.arange(0, n, dtype=torch.long, device=logits.device)
 
     if remove_duplicates:
-        labels = [map_idx[i] for i in labels]
-
-    labels = torch.LongTensor(labels).cuda()
-
-    if torch.cuda.is_available():
-        labels = labels.cuda()
+        labels = map_idx[labels]
 
-    if lam != None:
+    if both_sides:
+        # symmetric CLIP loss: z1 -> z2 over the rows, z2 -> z1 over the columns
+        loss = 0.5 * (torch.nn.functional.cross_entropy(logits, labels) + torch.nn.functional.cross_entropy(logits.T, labels))
+    elif lam != None:
         loss = (1 - lam) * torch.nn.functional.cross_entropy(logits, labels) + lam * torch.nn.functional.cross_entropy(logits, perm_idx) 
     else:
         loss = torch.nn.functional.cross_entropy(logits, labels)
     return loss
 
-def info_nce(z, temperature=0.1, distance="cosine", both_sides=True, lam=None, perm_idx=None, twoway=False, fourway=False, lr_weight=[1,1]):
-    # wrapper to do infonce on multiple contrastive objectives
+def _all_pairs_info_nce(z, temperature=0.1, distance="cosine", pre_normalized=False, labels=None, pairs=None):
+    """
+    Mean of _uni_info_nce over every ordered pair of different views, in one
+    batched matmul and one cross entropy call.
+    Both-sided and one-sided infoNCE give the same mean here, since the
+    columns of pair (a, b) are the rows of pair (b, a).
+    :param z: list of k views, each n x d
+    :param pre_normalized: views are already unit-norm (cosine only)
+    :param labels: prebuilt arange(n) repeated k * (k - 1) times
+    :param pairs: prebuilt (a, b) index tensors of the ordered pairs a != b
+    :return: mean infoNCE over the k * (k - 1) ordered pairs
+    """
+    if z[0].size()[1] <= 1 and distance == "cosine":
+        raise UserWarning('InfoNCE loss has only one dimension, add more dimensions')
+
+    k, n = len(z), z[0].shape[0]
+    z = torch.stack(z)
+    if distance == "cosine" and not pre_normalized:
+        z = torch.nn.functional.normalize(z, dim=-1)
+    if k == 2:
+        # pair (1, 0) is the transpose of pair (0, 1), so one matmul covers both
+        if distance == "cosine":
+            logits = z[0] @ z[1].T
+        elif distance == "euclidean":
+            logits = euclidean_dist(z[0], z[1])
+        logits = torch.cat([logits, logits.T])
+    else:
+        # only the off-diagonal blocks are computed, in row-major pair order
+        if pairs is None:
+            pairs = _view_pairs(k, z.device)
+        a, b = pairs
+        logits = z[a] @ z[b].transpose(-1, -2)
+        if distance == "euclidean":
+            sq = (z * z).sum(-1)
+            logits = 2 * logits - sq[a][:, :, None] - sq[b][:, None, :]
+        logits = logits.reshape((-1, n))
+    logits = logits / temperature
+
+    if labels is None:
+        labels = torch.arange(0, n, dtype=torch.long, device=logits.device).repeat(k * (k - 1))
+    return torch.nn.functional.cross_entropy(logits, labels)
+
+def _view_pairs(k, device):
+    a, b = zip(*[(i, j) for i in range(k) for j in range(k) if i != j])
+    return torch.tensor(a, device=device), torch.tensor(b, device=device)
+
+def info_nce(z, temperature=0.1, distance="cosine", both_sides=True, lam=None, perm_idx=None, twoway=False, fourway=False, lr_weight=[1,1], pre_normalized=False, cached=None):
+    # wrapper to do infonce on multiple contrastive objectives. cached is the
+    # (labels, pair_labels, pairs) tuple from info_nce_factory
+    labels, pair_labels, pairs = cached if cached is not None else (None, None, None)
     loss = []
     if not twoway and not fourway:
-        for it1, z1 in enumerate(z):
-            for it2, z2 in enumerate(z):
-                if it1 == it2:
-                    continue
-                
-                loss.append(torch.unsqueeze(_uni_info_nce(z1, z2, temperature, distance, both_sides), dim=0))
+        return _all_pairs_info_nce(z, temperature, distance, pre_normalized=pre_normalized, labels=pair_labels, pairs=pairs)
     elif twoway:
         for it, z2 in enumerate(z[1:]):
-            loss.append(torch.unsqueeze(_uni_info_nce(z[0], z2, temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx), dim=0) * lr_weight[it])
+            loss.append(torch.unsqueeze(_uni_info_nce(z[0], z2, temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx, pre_normalized=pre_normalized, labels=labels), dim=0) * lr_weight[it])
     elif fourway:
         for it, z2 in enumerate(z[1:]):
-            loss.append(torch.unsqueeze(_uni_info_nce(z[0], z2, temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx), dim=0) * lr_weight[it])
-            loss.append(torch.unsqueeze(_uni_info_nce(z2, z[0], temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx), dim=0) * lr_weight[it])
+            loss.append(torch.unsqueeze(_uni_info_nce(z[0], z2, temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx, pre_normalized=pre_normalized, labels=labels), dim=0) * lr_weight[it])
+            loss.append(torch.unsqueeze(_uni_info_nce(z2, z[0], temperature, distance, both_sides=False, lam=lam, perm_idx=perm_idx, pre_normalized=pre_normalized, labels=labels), dim=0) * lr_weight[it])
     loss = torch.mean(torch.cat(loss))
 
     return loss
 
+def info_nce_factory(n, k, device):
+    # info_nce with its label and pair index tensors built once, for the fixed
+    # pretraining batch size. other sizes (by_type batches) build their own
+    labels = torch.arange(0, n, dtype=torch.long, device=device)
+    cached = (labels, labels.repeat(k * (k - 1)), _view_pairs(k, device))
+
+    def cached_info_nce(z, **kwargs):
+        if z[0].shape[0] != n:
+            return info_nce(z, **kwargs)
+        return info_nce(z, cached=cached, **kwargs)
+    return cached_info_nce
+
 def confusion_matrix_str(cm, normalize=True, figs=3, label_names=None):
     if not normalize:
         raise NotImplementedError("non normalized arrays not available yet")
@@ -269,39 +300,24 @@ def confusion_matrix_str(cm, normalize=True, figs=3, label_names=None):
     reset = ""
     bounds = np.array([0, 0.2, 0.4, 0.6, 0.8])
 
-    ret = ""
-    ret += (" ") * (figs + 1)
-    for i in range(1, n + 1):
-        ret += " "
-        if label_names == None:
-            ret += '{:>{width}}'.format(str(i), width=figs + 1)
-        else:
-            ret += '{:>{width}}'.format(label_names[i - 1], width=figs + 1)
-    ret += "\n"
+    # format every cell at once; values below 1 drop their leading zero
+    cells = np.where(cm >= 1, np.char.mod(f'%.{figs - 1}f', cm), np.char.lstrip(np.char.mod(f'%.{figs}f', cm), '0'))
+    cells = np.where(np.isnan(cm), "nan".rjust(figs + 1), cells)
+    style = np.array(color_scale)[np.searchsorted(bounds, cm)].astype(object)
+    style[np.diag_indices(n)] += bold
+    cells = " " + style + cells.astype(object) + reset
 
-    for i in range(1, n + 1):
-        if label_names == None:
-            ret += '{:>{width}}'.format(str(i), width=figs + 1)
-        else:
-            ret += '{:>{width}}'.format(label_names[i - 1], width=figs + 1)
-
-        for j in range(1, n + 1):
-            ret += " "
-            ret += color_scale[np.searchsorted(bounds, cm[i - 1, j - 1])]
-            if i == j:
-                ret += bold
-            if str(cm[i - 1, j - 1]) == "nan":
-                ret += "nan".rjust(figs + 1)
-            elif cm[i - 1, j - 1] >= 1:
-                ret += '{:.{width}f}'.format(cm[i - 1, j - 1], width=figs - 1)
-            else:
-                ret += '{:.{width}f}'.format(cm[i - 1, j - 1], width=figs)[1:]
-            ret += reset
-        ret += "\n"
+    if label_names == None:
+        names = ['{:>{width}}'.format(str(i), width=figs + 1) for i in range(1, n + 1)]
+    else:
+        names = ['{:>{width}}'.format(label_names[i - 1], width=figs + 1) for i in range(1, n + 1)]
+
+    ret = (" ") * (figs + 1) + "".join(" " + name for name in names) + "\n"
+    ret += "".join(name + "".join(row) + "\n" for name, row in zip(names, cells))
 
     return ret
 
-def clip_acc(z1, z2, distance="cosine", as_confusion_matrix=False, labels=None, label_size=-1, remove_duplicates=False, targets=None):
+def clip_acc(z1, z2, distance="cosine", as_confusion_matrix=False, labels=None, label_size=-1, remove_duplicates=False, targets=None, pre_normalized=False):
     """
     CLIP classification accuracy objective.
     The task is vaguely matching each z1 to z2.
@@ -309,23 +325,19 @@ def clip_acc(z1, z2, distance="cosine", as_confusion_matrix=False, labels=None,
     :param z2: right outputs (targets)
     :param distance: distance metric to use
     :param targets: indices of targets for z1
+    :param pre_normalized: z1 and z2 are already unit-norm (cosine only)
     """
     if remove_duplicates and targets != None:
         raise ValueError("don't do both remove duplicates & targets for clip acc")
 
     if remove_duplicates:
-        z2_ = torch.unique(z2, dim=0)
-        map_idx = [-1000] * len(z2)
-        for i in range(len(z2_)):
-            mask = [torch.equal(x, z2_[i]) for x in z2]
-            mask = [it for it, elem in enumerate(mask) if elem]
-            for m in mask:
-                map_idx[m] = i
-        z2 = z2_
+        # map_idx[i] is the row of z2_ equal to z2[i]
+        z2, map_idx = torch.unique(z2, dim=0, return_inverse=True)
 
     if distance == "cosine":
-        z1 = torch.nn.functional.normalize(z1, dim=1)
-        z2 = torch.nn.functional.normalize(z2, dim=1)
+        if not pre_normalized:
+            z1 = torch.nn.functional.normalize(z1, dim=1)
+            z2 = torch.nn.functional.normalize(z2, dim=1)
         dists = torch.matmul(z1, z2.T) 
     elif distance == "euclidean":
         dists = euclidean_dist(z1, z2)
@@ -337,10 +349,9 @@ def clip_acc(z1, z2, distance="cosine", as_confusion_matrix=False, labels=None,
         default_targets = True
         targets = list(range(n))
 
-    if remove_duplicates:
-        targets = [map_idx[i] for i in targets]
-
     targets = torch.LongTensor(targets).cuda()
+    if remove_duplicates:
+        targets = map_idx[targets]
 
     if not as_confusion_matrix:
         neighbors = torch.argmax(dists, dim=1) 
@@ -352,42 +363,59 @@ def clip_acc(z1, z2, distance="cosine", as_confusion_matrix=False, labels=None,
             raise ValueError("Confusion matrix not implemented for nl targets")
 
         neighbors = torch.argmax(dists, dim=1) 
+        labels = torch.as_tensor(labels, device=neighbors.device).long()
         if label_size == -1:
-            label_size = int(max(labels)) + 1
-        pairs = torch.stack((neighbors, targets), dim=1)
-        pairs = pairs.detach().tolist()
-        pairs = [[int(labels[x].item()) for x in l] for l in pairs]
-        cm = np.zeros((label_size, label_size))
-        for pair in pairs:
-            cm[pair[0], pair[1]] = cm[pair[0], pair[1]] + 1
+            label_size = int(labels.max()) + 1
+        # cm[predicted label, true label], counted in one bincount
+        flat = labels[neighbors] * label_size + labels[targets]
+        cm = torch.bincount(flat, minlength=label_size * label_size).reshape((label_size, label_size))
+        cm = cm.cpu().numpy().astype('float64')
 
         if default_targets:
-            class_sizes = []
-            class_accs = []
-            for i in range(label_size):
-                class_sizes.append(torch.numel(torch.where(labels == i)[0]))
-
-                if class_sizes[-1] == 0:
-                    class_accs.append(float('nan'))
-                    continue
-
-                dists_mini = dists[labels == i, :]
-                dists_mini = dists_mini[:, labels == i]
-                dists_mini = dists_mini.reshape((class_sizes[-1], class_sizes[-1]))
-                nb_mini = torch.argmax(dists_mini, dim=1)
-
-                nb_mini = nb_mini - torch.arange(0, class_sizes[-1]).cuda()
-                class_accs.append(torch.numel(torch.where(nb_mini == 0)[0]) / class_sizes[-1]) 
+            # within-class matching: mask out other classes and argmax once
+            same_class = labels[:, None] == labels[None, :]
+            nb_mini = torch.argmax(dists.masked_fill(~same_class, float('-inf')), dim=1)
+            correct = (nb_mini == targets).double()
+
+            class_sizes = torch.bincount(labels, minlength=label_size)
+            class_hits = torch.bincount(labels, weights=correct, minlength=label_size)
+            class_accs = (class_hits / class_sizes).tolist() # 0 / 0 gives nan for empty classes
+            class_sizes = class_sizes.tolist()
             return class_accs, class_sizes, cm
         else:
             return cm
 
+def loader_kwargs(drop_last=True):
+    # every dataset keeps its tensors on the gpu, which can't be pinned or
+    # used from forked workers, so loading stays in-process
+    return dict(drop_last=drop_last, pin_memory=False, num_workers=0)
+
+_eval_streams = None
+def forward_pair(encoder1, x1, encoder2, x2):
+    # runs two encoders on their own cuda streams so they can overlap
+    global _eval_streams
+    if not torch.cuda.is_available():
+        return encoder1(x1), encoder2(x2)
+    if _eval_streams is None:
+        _eval_streams = (torch.cuda.Stream(), torch.cuda.Stream())
+
+    main_stream = torch.cuda.current_stream()
+    outs = []
+    for stream, encoder, x in zip(_eval_streams, (encoder1, encoder2), (x1, x2)):
+        stream.wait_stream(main_stream)
+        with torch.cuda.stream(stream):
+            outs.append(encoder(x))
+    for stream, out in zip(_eval_streams, outs):
+        main_stream.wait_stream(stream)
+        out.record_stream(main_stream) # out is freed after main_stream is done with it
+    return outs
+
 def validate(args, encoder, datahandler):
     encoder = evaluate_single(args, [encoder], datahandler, -1, clip_inv=False) 
     return encoder
 
 def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=[-1], encoder_idx=0, finetune=True, expensive=False):
-    dataloader_kwargs = dict(drop_last=True, pin_memory=False, num_workers=0)
+    dataloader_kwargs = loader_kwargs()
 
     if tasks == [-1]:
         tasks = args.zero_shot + args.finetune
@@ -415,8 +443,6 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
             cms_acc = []
             cms_total = []
             if expensive:
-                pcs_acc = []
-                pcs_total = []
                 pcs_manual = []
                 pcs_mtotal = []
                 sites_acc = []
@@ -425,6 +451,8 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
             distance = "cosine"
             if args.euclidean:
                 distance = "euclidean"
+            # cosine outputs are normalized once per batch and shared by every metric
+            pre_norm = distance == "cosine"
            
             if expensive:
                 num_rep = args.type_reps
@@ -432,13 +460,15 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
                 num_rep = 1
             for _ in tqdm(range(num_rep)):
                 for it, elem in enumerate(val_loader):
-                    with torch.no_grad():
-                        base_out = encoders[encoder_idx](elem[args.contrastive[encoder_idx]])
-                        comp_out = encoders[oit](elem[dtype])
-
-                        acc.append(clip_acc(base_out, comp_out, distance=distance))
-                        loss.append(info_nce([base_out, comp_out], distance=distance).item())
-                        pc1, pc2, cm = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types)
+                    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
+                        base_out, comp_out = forward_pair(encoders[encoder_idx], elem[args.contrastive[encoder_idx]], encoders[oit], elem[dtype])
+                        if pre_norm:
+                            base_out = torch.nn.functional.normalize(base_out, dim=1)
+                            comp_out = torch.nn.functional.normalize(comp_out, dim=1)
+
+                        acc.append(clip_acc(base_out, comp_out, distance=distance, pre_normalized=pre_norm))
+                        loss.append(info_nce([base_out, comp_out], distance=distance, pre_normalized=pre_norm).item())
+                        pc1, pc2, cm = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types, pre_normalized=pre_norm)
                         
                     cms.append(cm)
                     cms_acc.append(pc1)
@@ -451,16 +481,24 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
                     type_loader = datahandler.by_type(args.type_bsz, select_size=-1, dataset='test', reps=1) 
                 overpredict_rat = []
                 overpredict_adj = []
-                for it, elem in tenumerate(type_loader, total=args.type_reps * datahandler.num_types if dtype == "reports" else datahandler.num_types):
-                    with torch.no_grad():
-                        base_out = encoders[encoder_idx](elem[args.contrastive[encoder_idx]])
-                        comp_out = encoders[oit](elem[dtype])
+                # by_type yields at most one batch per type per rep
+                num_batches = args.type_reps * datahandler.num_types if dtype == "reports" else datahandler.num_types
+                pcs_acc = np.empty((num_batches, datahandler.num_types))
+                pcs_total = np.empty((num_batches, datahandler.num_types), dtype=int)
+                num_pcs = 0
+                for it, elem in tenumerate(type_loader, total=num_batches):
+                    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
+                        base_out, comp_out = forward_pair(encoders[encoder_idx], elem[args.contrastive[encoder_idx]], encoders[oit], elem[dtype])
+                        base_n = torch.nn.functional.normalize(base_out, dim=1)
+                        comp_n = torch.nn.functional.normalize(comp_out, dim=1)
+                        if pre_norm:
+                            base_out, comp_out = base_n, comp_n
 
                         if dtype == "reports" and args.compare_nl:
                             with open("compare_nl.txt", "a") as f:
                                 y_true = elem["reports"]["input_ids"]
                                 y_true_id = elem["id"][0]
-                                y_pred = torch.nn.functional.normalize(base_out, dim=1) @ torch.nn.functional.normalize(comp_out, dim=1).T
+                                y_pred = base_n @ comp_n.T
                                 y_pred = torch.argmax(y_pred, axis=1)
                                 y_pred_id = [elem["id"][0][x] for x in y_pred.tolist()]
                                 y_pred = y_true[y_pred]
@@ -470,53 +508,49 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
                                 overpredict_rat.append(len([it for it in range(len(y_true_site)) if y_true_site[it] == y_pred_site[it]]) / len(y_true) * len(list(set(y_true_site))))
                                 overpredict_adj.append(len([it for it in range(len(y_true_site)) if y_true_site[it] == y_pred_site[it] and y_true_id[it] != y_pred_id[it]]) / len(y_true) * len(list(set(y_true_site))))
 
-                                y_true = [datahandler.tokenizer.convert_ids_to_tokens(w) for w in y_true]
-                                y_pred = [datahandler.tokenizer.convert_ids_to_tokens(w) for w in y_pred]
-                                y_true = [datahandler.tokenizer.convert_tokens_to_string(w) for w in y_true]
-                                y_pred = [datahandler.tokenizer.convert_tokens_to_string(w) for w in y_pred]
-                                y_true = [" ".join([l for l in w.split() if "[" not in l]) for w in y_true]
-                                y_pred = [" ".join([l for l in w.split() if "[" not in l]) for w in y_pred]
+                                y_true = datahandler.tokenizer.batch_decode(y_true, skip_special_tokens=True)
+                                y_pred = datahandler.tokenizer.batch_decode(y_pred, skip_special_tokens=True)
                                 f.write(str(save_num) + "\n")
                                 f.write(str(datahandler.nl_type_map[it % len(datahandler.nl_type_map)]) + "\n")
                                 f.write("\n".join([str((a, b, c, d)) for a, b, c, d in zip(y_true_id, y_true, y_pred_id, y_pred)]))
                                 f.write("\n\n")
 
-                        site_elem = [x[5:7] for x in elem["id"][0]]
-                        site_set = list(set(site_elem))
-                        si1, si2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=torch.Tensor([site_set.index(x) for x in site_elem]).cuda(), label_size=len(site_set))
-                        pc1, pc2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types)
-                    pcs_acc.append(pc1)
-                    pcs_total.append(pc2)
-                    sites_acc = sites_acc + si1
-                    sites_total = sites_total + si2
+                        site_set, site_elem = np.unique(np.array([x[5:7] for x in elem["id"][0]]), return_inverse=True)
+                        si1, si2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=torch.from_numpy(site_elem).to(base_out.device), label_size=len(site_set), pre_normalized=pre_norm)
+                        pc1, pc2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types, pre_normalized=pre_norm)
+                    pcs_acc[num_pcs] = pc1
+                    pcs_total[num_pcs] = pc2
+                    num_pcs += 1
+                    sites_acc.extend(si1)
+                    sites_total.extend(si2)
 
                 if dtype == "reports" and args.compare_nl:
                     for ctype in args.manual:
                         manual_loader = datahandler.manual_loader(args.type_bsz, reps=args.type_reps, type=ctype) 
                         
                         for it, elem in tenumerate(manual_loader):
-                            with torch.no_grad():
+                            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
                                 base_out = encoders[encoder_idx](elem[args.contrastive[encoder_idx]])
                                 comp_out = encoders[oit](elem["manual-" + dtype])
+                                base_n = torch.nn.functional.normalize(base_out, dim=1)
+                                comp_n = torch.nn.functional.normalize(comp_out, dim=1)
+                                if pre_norm:
+                                    base_out, comp_out = base_n, comp_n
 
                                 with open("compare_nl_manual.txt", "a") as f:
                                     y_true = elem["manual-reports"]["input_ids"]
-                                    y_pred = torch.nn.functional.normalize(base_out, dim=1) @ torch.nn.functional.normalize(comp_out, dim=1).T
+                                    y_pred = base_n @ comp_n.T
                                     y_pred = torch.argmax(y_pred, axis=1)
                                     y_pred = y_true[y_pred]
 
-                                    y_true = [datahandler.tokenizer.convert_ids_to_tokens(w) for w in y_true]
-                                    y_pred = [datahandler.tokenizer.convert_ids_to_tokens(w) for w in y_pred]
-                                    y_true = [datahandler.tokenizer.convert_tokens_to_string(w) for w in y_true]
-                                    y_pred = [datahandler.tokenizer.convert_tokens_to_string(w) for w in y_pred]
-                                    y_true = [" ".join([l for l in w.split() if "[" not in l]) for w in y_true]
-                                    y_pred = [" ".join([l for l in w.split() if "[" not in l]) for w in y_pred]
+                                    y_true = datahandler.tokenizer.batch_decode(y_true, skip_special_tokens=True)
+                                    y_pred = datahandler.tokenizer.batch_decode(y_pred, skip_special_tokens=True)
                                     f.write(str(save_num) + "\n")
                                     f.write(str(it) + "\n")
                                     f.write("\n".join([str((x, y)) for x, y in zip(y_true, y_pred)]))
                                     f.write("\n\n")
 
-                                pc1, pc2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types)
+                                pc1, pc2, _ = clip_acc(base_out, comp_out, distance=distance, as_confusion_matrix=True, labels=elem["type"], label_size=datahandler.num_types, pre_normalized=pre_norm)
                             pcs_manual.append(pc1)
                             pcs_mtotal.append(pc2)
 
@@ -525,8 +559,8 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
             cms_sample = np.nanmean(np.array(cms_total), axis=0)
             loss = np.array(loss)
             if expensive:
-                pcs_acc = np.nanmean(np.array(pcs_acc), axis=0)
-                pcs_sample = np.reciprocal(np.sum(np.reciprocal(np.array(pcs_total)), axis=0)) / args.type_reps
+                pcs_acc = np.nanmean(pcs_acc[:num_pcs], axis=0)
+                pcs_sample = np.reciprocal(np.sum(np.reciprocal(pcs_total[:num_pcs]), axis=0)) / args.type_reps
                 pcs_manual = np.nanmean(np.array(pcs_manual), axis=0)
                 pcs_msample = np.sum(np.array(pcs_mtotal), axis=0) / args.type_reps
                 print(np.bincount(np.array(sites_total)), "sites")
@@ -593,7 +627,7 @@ def evaluate_single(args, encoders, datahandler, save_num, clip_inv=True, tasks=
                     true = []
                     predict = []
                     ids = []
-                    with torch.no_grad():
+                    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
                         for it, elem in enumerate(test_loader):
                             ft_out = torch.unsqueeze(ft_encoder(elem[args.contrastive[encoder_idx]]), 1)
                             nl_out = torch.stack((
@@ -645,8 +679,6 @@ def write_all(args, encoders, datahandler):
         if t[-3:] == '_nl':
             columns = columns + [t[:-3]]
 
-    df = pd.DataFrame(columns=columns)
-
     for encoder in encoders:
         encoder.eval()
 
@@ -654,19 +686,18 @@ def write_all(args, encoders, datahandler):
             dataset=datahandler.pretrain,
             shuffle=False,
             batch_size=args.bsz,
-            drop_last=False,
-            pin_memory=False,
-            num_workers=0
+            **loader_kwargs(drop_last=False)
     )
     test_loader = torch.utils.data.DataLoader(
             dataset=datahandler.clip_test,
             shuffle=False,
             batch_size=args.bsz,
-            drop_last=False,
-            pin_memory=False,
-            num_workers=0
+            **loader_kwargs(drop_last=False)
     )
 
+    # batches are collected and concatenated once, DataFrame.append copies every call
+    data = []
+    ids = []
     with torch.no_grad():
         for (test_indicator, loader) in zip((False, True), (train_loader, test_loader)):
             for elem in loader:
@@ -681,11 +712,14 @@ def write_all(args, encoders, datahandler):
                 for task in args.finetune:
                     if task[-3:] == "_nl":
                         temp_nd[:, add_it] = elem[task[:-3]].cpu().numpy()
-                df = df.append(pd.DataFrame(
-                    data=temp_nd,
-                    index=elem["id"][0],
-                    columns=columns
-                ))
+                data.append(temp_nd)
+                ids += list(elem["id"][0])
+
+    df = pd.DataFrame(
+        data=np.concatenate(data) if len(data) > 0 else np.zeros((0, len(columns))),
+        index=ids,
+        columns=columns
+    )
 
     print(df.head(10))
     print(df.tail(10))
@@ -693,10 +727,165 @@ def write_all(args, encoders, datahandler):
     df.to_csv(args.path_dir + "/outputs.csv")
     return 
 
+def to_device(elem, device, non_blocking=False):
+    # batches are dicts of tensors (or tokenizer outputs) plus id lists
+    if torch.is_tensor(elem):
+        return elem.to(device, non_blocking=non_blocking)
+    if isinstance(elem, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in elem.items()}
+    return elem
+
+def shard_batch(elem, rank, world_size):
+    # this rank's contiguous share of a batch every rank holds in full; the
+    # remainder is dropped so all shards (and all_gathers) have one size
+    first = next(_batch_tensors(elem))
+    per = first.shape[0] // world_size
+    def shard(x):
+        if torch.is_tensor(x) or isinstance(x, list):
+            return x[rank * per:(rank + 1) * per]
+        if isinstance(x, dict):
+            return {k: shard(v) for k, v in x.items()}
+        return x
+    return shard(elem), per
+
+def gather_cat(t):
+    # all_gather without autograd, concatenated in rank order
+    parts = [torch.empty_like(t) for _ in range(dist.get_world_size())]
+    dist.all_gather(parts, t.contiguous())
+    return torch.cat(parts)
+
+def _batch_tensors(elem):
+    if torch.is_tensor(elem):
+        yield elem
+    elif isinstance(elem, dict):
+        for v in elem.values():
+            yield from _batch_tensors(v)
+
+def prefetch_to_device(batches, device):
+    # copies batch i+1 on a side stream while batch i is computed on. each
+    # batch carries its own event, so the compute stream waits for that copy only
+    copy_stream = torch.cuda.Stream(device)
+    pending = None
+    for elem in batches:
+        with torch.cuda.stream(copy_stream):
+            elem = to_device(elem, device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        if pending is not None:
+            yield _wait_batch(*pending, device)
+        pending = (elem, ready)
+    if pending is not None:
+        yield _wait_batch(*pending, device)
+
+def _wait_batch(elem, ready, device):
+    stream = torch.cuda.current_stream(device)
+    stream.wait_event(ready)
+    # the copies were allocated on the side stream but are freed on this one
+    for t in _batch_tensors(elem):
+        t.record_stream(stream)
+    return elem
+
+def load_encoder_state(encoder, path):
+    sdict = torch.load(path)["state_dict"]
+    try:
+        encoder.load_state_dict(sdict)
+    except RuntimeError:
+        # saved from inside a DataParallel/DDP wrapper
+        sdict = {(k[7:] if k.startswith("module.") else k): v for k, v in sdict.items()}
+        encoder.load_state_dict(sdict, strict=True)
+
+def cpu_state_dict(module, out=None):
+    # copies into pinned host buffers so the device->host copies run async;
+    # pass the previous result as out to reuse its buffers instead of pinning
+    # new ones. one stream sync before the saver thread reads them
+    state = module.state_dict()
+    if out is None:
+        out = {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=True) for k, v in state.items()}
+    for k, v in state.items():
+        out[k].copy_(v.detach(), non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+    return out
+
+def save_checkpoint(path_dir, e, states, data_args=None):
+    # runs on the saver thread. the .args file (or, when the args haven't
+    # changed, an .epoch marker) goes last, since loading takes the newest one
+    # as the newest complete checkpoint
+    for name, state in states.items():
+        torch.save(dict(epoch=0, state_dict=state), os.path.join(path_dir, f'{e}-{name}.pth'))
+
+    if data_args is not None:
+        with open(os.path.join(path_dir, f'{e}.args'), 'w') as fp:
+            json.dump(data_args, fp)
+    else:
+        with open(os.path.join(path_dir, f'{e}.epoch'), 'w') as fp:
+            fp.write(str(e))
+
+def saved_args_path(path_dir, epoch):
+    # args are only rewritten when they change, so an epoch's args are the
+    # newest .args at or before it
+    for e in range(epoch, -1, -1):
+        path = os.path.join(path_dir, f"{e}.args")
+        if os.path.isfile(path):
+            return path
+    return os.path.join(path_dir, f"{epoch}.args")
+
 def pretrain(args, encoders, datahandler):
+    world_size = len(args.gpu.split(","))
+    if world_size == 1:
+        return main_worker(0, 1, args, encoders, datahandler)
+
+    # one process per gpu, gradients allreduced over nccl. rank 0 logs,
+    # evaluates and saves; its final weights are loaded back here
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    if "MASTER_PORT" not in os.environ:
+        # run_script runs a job per gpu group on the same host, so each job
+        # needs its own rendezvous port rather than a fixed one
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            os.environ["MASTER_PORT"] = str(sock.getsockname()[1])
+    mp.spawn(main_worker, args=(world_size, args, encoders, datahandler), nprocs=world_size)
+    for encoder, name in zip(encoders, args.contrastive):
+        load_encoder_state(encoder, os.path.join(args.path_dir, f'{args.epochs}-{name}.pth'))
+
+    return encoders
+
+def main_worker(local_rank, world_size, args, encoders, datahandler):
+    global verbose, log_file, _uni_info_nce, _all_pairs_info_nce
+    distributed = world_size > 1
+    is_main = local_rank == 0
+    if distributed:
+        # spawned workers start from a fresh interpreter
+        verbose = args.verbose
+        log_file = args.path_dir + '/all.log'
+        # ranks 1.. wait in a barrier while rank 0 evaluates and runs write_all
+        # alone, which can take far longer than nccl's default timeout
+        dist.init_process_group(backend='nccl', init_method='env://', world_size=world_size, rank=local_rank,
+                timeout=datetime.timedelta(minutes=args.dist_timeout))
+        torch.cuda.set_device(local_rank)
+        for encoder in encoders:
+            encoder.cuda(local_rank)
+        if args.compile:
+            _uni_info_nce = torch.compile(_uni_info_nce, dynamic=True)
+            _all_pairs_info_nce = torch.compile(_all_pairs_info_nce, dynamic=True)
+
     # dataset
-    dataloader_kwargs = dict(drop_last=True, pin_memory=False, num_workers=0)
-    if args.site_batch != 1:
+    dataloader_kwargs = loader_kwargs()
+    sampler = None
+    if distributed:
+        # bsz stays the global batch, as it was under DataParallel: each rank
+        # loads its share, and the embeddings are all-gathered for the loss
+        local_bsz = args.bsz // world_size
+        if args.site_batch != 1:
+            sampler = datasets.DistributedSiteSampler(datahandler.pretrain, local_bsz, num_replicas=world_size, rank=local_rank, num_matches=args.site_batch)
+        else:
+            sampler = torch.utils.data.distributed.DistributedSampler(datahandler.pretrain, num_replicas=world_size, rank=local_rank, shuffle=True)
+        train_loader = torch.utils.data.DataLoader(
+            dataset=datahandler.pretrain,
+            batch_size=local_bsz,
+            sampler=sampler,
+            **dataloader_kwargs
+        )
+    elif args.site_batch != 1:
         sampler = datasets.SiteSampler(datahandler.pretrain, num_matches=args.site_batch)
         train_loader = torch.utils.data.DataLoader(
             dataset=datahandler.pretrain,
@@ -712,168 +901,239 @@ def pretrain(args, encoders, datahandler):
             **dataloader_kwargs
         )
 
+    if len(train_loader) // args.accum_steps == 0:
+        # the lr tables would be empty, with no optimizer step in an epoch
+        raise ValueError(f"--accum_steps {args.accum_steps} is more than the {len(train_loader)} batches in an epoch")
+
     if verbose:
         pwint("[Pretraining] Completed data loading")
 
-    # optimization
-    optimizers = []
-    lr_schedulers = []
+    # optimization. the schedules see the effective batch, bsz * accum_steps
+    # fused AdamW where there's a gpu; fused and foreach are mutually exclusive
+    adamw_kwargs = dict(fused=True) if torch.cuda.is_available() else dict(foreach=True)
+    # (optimizer, lr table) pairs; the table is indexed by optimizer step
+    steps = []
     for encoder in encoders:
         if isinstance(encoder, model.TransformerWithMLP):
-            trns_optimizer = torch.optim.AdamW(encoder.trns.parameters(), lr=args.l_lr[0], weight_decay=args.wd)
-            mlp_optimizer = torch.optim.AdamW(encoder.mlp.parameters(), lr=args.l_lr[1], weight_decay=args.wd)
-            
-            optimizers += [trns_optimizer, mlp_optimizer]
-            
-            trns_lr_scheduler = LRScheduler(
-                    optimizer=trns_optimizer,
-                    warmup_epochs=args.warmup_epochs,
-                    warmup_lr=0 if args.flat_lr or args.cosine_lr else args.l_lr[0] * args.bsz / 256,
-                    num_epochs=args.epochs,
-                    base_lr=args.l_lr[0] * args.bsz / 256,
-                    final_lr=0 if args.cosine_lr else args.l_lr[0] * args.bsz / 256,
-                    iter_per_epoch=len(train_loader),
-                    constant_predictor_lr=True,
-                    flat_warmup=args.flat_lr
-            )
-            mlp_lr_scheduler = LRScheduler(
-                    optimizer=mlp_optimizer,
-                    warmup_epochs=args.warmup_epochs,
-                    warmup_lr=0 if args.cosine_lr else args.l_lr[1] * args.bsz / 256,
-                    num_epochs=args.epochs,
-                    base_lr=args.l_lr[1] * args.bsz / 256,
-                    final_lr=0 if args.cosine_lr else args.l_lr[1] * args.bsz / 256,
-                    iter_per_epoch=len(train_loader),
-                    constant_predictor_lr=True,
-                    flat_warmup=False
-            )
-        elif isinstance(encoder, model.SimpleMLP):
-            mlp_optimizer = torch.optim.AdamW(encoder.parameters(), lr=args.g_lr, weight_decay=args.wd)
+            trns_optimizer = torch.optim.AdamW(encoder.trns.parameters(), lr=args.l_lr[0], weight_decay=args.wd, **adamw_kwargs)
+            mlp_optimizer = torch.optim.AdamW(encoder.mlp.parameters(), lr=args.l_lr[1], weight_decay=args.wd, **adamw_kwargs)
 
-            optimizers += [mlp_optimizer]
+            # the trns/mlp optimizers have never followed a schedule
+            steps += [(trns_optimizer, None), (mlp_optimizer, None)]
+        elif isinstance(encoder, model.SimpleMLP):
+            mlp_optimizer = torch.optim.AdamW(encoder.parameters(), lr=args.g_lr, weight_decay=args.wd, **adamw_kwargs)
 
-            lr_scheduler = LRScheduler(
-                    optimizer=mlp_optimizer,
+            lr_table = build_lr_table(
                     warmup_epochs=args.warmup_epochs,
-                    warmup_lr=0 if args.cosine_lr else args.g_lr * args.bsz / 256,
+                    warmup_lr=0 if args.cosine_lr else args.g_lr * args.bsz * args.accum_steps / 256,
                     num_epochs=args.epochs,
-                    base_lr=args.g_lr * args.bsz / 256,
-                    final_lr=0 if args.cosine_lr else args.g_lr * args.bsz / 256,
-                    iter_per_epoch=len(train_loader),
-                    constant_predictor_lr=True,
+                    base_lr=args.g_lr * args.bsz * args.accum_steps / 256,
+                    final_lr=0 if args.cosine_lr else args.g_lr * args.bsz * args.accum_steps / 256,
+                    iter_per_epoch=len(train_loader) // args.accum_steps,
                     flat_warmup=False
             )
 
-            lr_schedulers += [lr_scheduler]
+            steps += [(mlp_optimizer, lr_table)]
         elif isinstance(encoder, CombTabTransformer):
-            trns_optimizer = torch.optim.AdamW(encoder.parameters(), lr=args.c_lr, weight_decay=args.wd)
-
-            optimizers += [trns_optimizer]
+            trns_optimizer = torch.optim.AdamW(encoder.parameters(), lr=args.c_lr, weight_decay=args.wd, **adamw_kwargs)
 
-            lr_scheduler = LRScheduler(
-                    optimizer=trns_optimizer,
+            lr_table = build_lr_table(
                     warmup_epochs=args.warmup_epochs,
-                    warmup_lr=0 if args.cosine_lr else args.c_lr * args.bsz / 256,
+                    warmup_lr=0 if args.cosine_lr else args.c_lr * args.bsz * args.accum_steps / 256,
                     num_epochs=args.epochs,
-                    base_lr=args.c_lr * args.bsz / 256,
-                    final_lr=0 if args.cosine_lr else args.c_lr * args.bsz / 256,
-                    iter_per_epoch=len(train_loader),
-                    constant_predictor_lr=True,
+                    base_lr=args.c_lr * args.bsz * args.accum_steps / 256,
+                    final_lr=0 if args.cosine_lr else args.c_lr * args.bsz * args.accum_steps / 256,
+                    iter_per_epoch=len(train_loader) // args.accum_steps,
                     flat_warmup=False
             )
 
-            lr_schedulers += [lr_scheduler]
-    if len(args.gpu) > 1:
-        multi_encoders = []
-        for encoder in encoders:
-            multi_encoders.append(convert_model(nn.DataParallel(encoder)).cuda())
-        encoders = multi_encoders
-
+            steps += [(trns_optimizer, lr_table)]
+    eval_encoders = encoders
+    if distributed:
+        # convert_sync_batchnorm reuses the parameters, so the optimizers above still hold
+        # static_graph also covers parameters a forward never touches (e.g. the bert
+        # pooler), and lets DDP reorder buckets to match the backward after the
+        # first step. 100MB buckets split distilbert's ~265MB of fp32 grads into
+        # three, so its top layers allreduce while the lower ones are still in backward
+        encoders = [DDP(nn.SyncBatchNorm.convert_sync_batchnorm(encoder), device_ids=[local_rank], bucket_cap_mb=100,
+                gradient_as_bucket_view=True, static_graph=True, find_unused_parameters=False) for encoder in encoders]
+        # rank 0 evaluates alone, so it evaluates outside DDP
+        eval_encoders = [nn.DataParallel(encoder.module, device_ids=[local_rank]) for encoder in encoders]
+    # the training forward goes through train_encoders; saving, mode switches and
+    # evaluation keep using encoders, so eval batch sizes never hit the compiled graph
+    train_encoders = encoders
+    if args.compile:
+        # compiled after the DDP wrap so dynamo can split graphs at the allreduce
+        # buckets. dynamic is left unset: the bsz batches compile static, and the
+        # first differently sized (by_type) batch switches to a dynamic batch dim
+        # instead of autotuning again for every size
+        train_encoders = [torch.compile(encoder, mode='max-autotune') for encoder in encoders]
+    # DDP and DataParallel share the wrapped module's parameters, so these hold either way
+    clip_params = [list(encoder.parameters()) for encoder in encoders]
 
     if verbose:
         pwint("[Pretraining] Model generation complete, training begins")
 
     # logging
     start = time.time()
-    os.makedirs(args.path_dir, exist_ok=True)
-    for encoder, dtype in zip(encoders, args.contrastive):
-        torch.save(dict(epoch=0, state_dict=encoder.state_dict()), os.path.join(args.path_dir, "0-" + dtype + ".pth"))
-
     data_args = vars(args)
-
-    with open(os.path.join(args.path_dir, '0.args'), 'w') as fp:
-        json.dump(data_args, fp, indent=4)
-
-    saved_loss = [-1]
-    saved_vars = []
-    for x in args.contrastive:
-        saved_vars.append([-1])
+    # checkpoints are written on one background thread while training goes on
+    saver = ThreadPoolExecutor(max_workers=1)
+    saves = []
+    if is_main:
+        os.makedirs(args.path_dir, exist_ok=True)
+        states = {dtype: cpu_state_dict(encoder) for encoder, dtype in zip(encoders, args.contrastive)}
+        saves.append(saver.submit(save_checkpoint, args.path_dir, 0, states, dict(data_args)))
+    saved_args = json.dumps(data_args, sort_keys=True)
+
+    # per-step loss and output spread stay on the gpu, and are only copied
+    # back at progress_every. allocated once and reused every epoch, since only
+    # the first logged rows are read; -1 until the first epoch has run
+    # by_type yields at most one batch per picked type, and picks all of them for -1
+    type_batches = datahandler.num_types if args.type_num == -1 else min(args.type_num, datahandler.num_types)
+    steps_per_epoch = len(train_loader) + type_batches
+    loss_buf = torch.full((steps_per_epoch,), -1.0, device='cuda')
+    var_buf = torch.full((steps_per_epoch, len(args.contrastive)), -1.0, device='cuda')
+    logged = 1
 
     distance = "cosine"
     if args.euclidean:
         distance = "euclidean"
 
+    # bf16 keeps fp32's exponent range, so loss scaling is only needed for fp16;
+    # otherwise the scaler is a no-op passthrough
+    amp_dtype = torch.float16 if args.amp_dtype == 'fp16' else torch.bfloat16
+    scaler = torch.amp.GradScaler('cuda', enabled=args.amp and amp_dtype == torch.float16)
+    loss_fn = info_nce_factory(args.bsz // world_size * world_size, len(args.contrastive), torch.device('cuda', local_rank))
+    global_step = 0
+    # one bar for the whole run rather than one per epoch
+    pbar = tqdm(total=args.epochs * steps_per_epoch, disable=not is_main)
+
+    # only the evaluations below leave train mode, so switch back after them
+    # rather than every epoch
+    for encoder in encoders:
+        encoder.train()
+
     for e in range(1, args.epochs + 1):
-        if e % args.progress_every == 0:
-            with torch.no_grad():
+        if e % args.progress_every == 0 and is_main:
+            with torch.inference_mode():
                 pwint("epoch ", e, "!")
-                pwint("loss: ", torch.mean(torch.Tensor(saved_loss)))
-                for it, dtype in enumerate(args.contrastive):
-                    pwint(f"{dtype} var:", torch.mean(torch.Tensor(saved_vars[it])))
-
-        for encoder in encoders:
-            encoder.train()
-
-        saved_loss = []
-        for var in saved_vars:
-            var = []
+                # one copy back for the loss and every variance
+                means = torch.cat([loss_buf[:logged].mean(0, keepdim=True), var_buf[:logged].mean(0)]).tolist()
+                pwint("loss: ", means[0])
+                for ci, dtype in enumerate(args.contrastive):
+                    pwint(f"{dtype} var:", means[1 + ci])
+
+        logged = 0
+
+        type_rand = None
+        if distributed:
+            sampler.set_epoch(e)
+            # every rank must pick the same types, or they run different step counts
+            type_rand = random.Random(e)
+        train_tloader = datahandler.by_type(args.type_bsz, select_size=args.type_num, dataset='pretrain', rand=type_rand)
+        if distributed:
+            # every rank draws the same type batches (same rand), and keeps its shard
+            train_tloader = (shard for shard, per in (shard_batch(elem, local_rank, world_size) for elem in train_tloader) if per > 0)
+        batches = chain(train_loader, train_tloader)
+        if distributed:
+            # the datasets live on cuda:0
+            batches = prefetch_to_device(batches, torch.device('cuda', local_rank))
+        for it, elem in enumerate(batches):
+            pbar.update()
+            # grads left from an unfinished window are dropped here each epoch
+            if it % args.accum_steps == 0:
+                for optimizer, _ in steps:
+                    optimizer.zero_grad(set_to_none=True)
+
+            sync_step = (it + 1) % args.accum_steps == 0
+            with ExitStack() as no_sync:
+                if distributed and not sync_step:
+                    # accumulate locally; only the window's last backward allreduces
+                    for encoder in encoders:
+                        no_sync.enter_context(encoder.no_sync())
+
+                outs = []
+                if args.mixup_scale > 0:
+                    perm_idx, lam, elem = datahandler.mixup(elem, scale=args.mixup_scale)
+                with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=args.amp):
+                    for ci, dtype in enumerate(args.contrastive):
+                        outs.append(train_encoders[ci](elem[dtype]))
+                    loss_outs = outs
+                    if distributed:
+                        # infoNCE over the global batch, negatives from every rank as under
+                        # DataParallel; torch.distributed.nn.all_gather carries the grads back
+                        loss_outs = [torch.cat(torch.distributed.nn.all_gather(out)) for out in outs]
+                        if args.mixup_scale > 0:
+                            perm_idx = gather_cat(perm_idx + local_rank * outs[0].shape[0])
+                            lam = gather_cat(lam)
+                    if args.mixup_scale > 0:
+                        l = loss_fn(loss_outs, distance=distance, twoway=True, lam=lam, perm_idx=perm_idx, temperature=args.temp)
+                    else:
+                        l = loss_fn(loss_outs, distance=distance, twoway=args.twoway, fourway=args.fourway, lr_weight=args.lr_weight, temperature=args.temp)
+
+                loss_buf[it] = l.detach()
+                for ci, out in enumerate(outs):
+                    var_buf[it, ci] = out.detach().std(0).mean()
+                logged = it + 1
+
+                scaler.scale(l / args.accum_steps).backward()
+            if not sync_step:
+                continue
 
-        train_tloader = datahandler.by_type(args.type_bsz, select_size=args.type_num, dataset='pretrain')
-        for it, elem in tenumerate(chain(train_loader, train_tloader), total=len(train_loader) + args.type_num):
+            if args.clip != -1:
+                # clip the true gradients, not the scaled ones
+                for optimizer, _ in steps:
+                    scaler.unscale_(optimizer)
+                for params in clip_params:
+                    torch.nn.utils.clip_grad_norm_(params, args.clip, foreach=True)
+            for optimizer, lr_table in steps:
+                scaler.step(optimizer)
+                if lr_table is not None:
+                    # by_type batches run past the table, which holds its last value
+                    lr = float(lr_table[min(global_step, len(lr_table) - 1)])
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
+            scaler.update()
+            global_step += 1
+
+        if e % args.val_every == 0 and is_main:
+            evaluate_single(args, eval_encoders, datahandler, e, tasks=[])
+
+        if e % args.eval_every == 0 and is_main:
+            evaluate_single(args, eval_encoders, datahandler, e, expensive=True)
+
+        if e % args.val_every == 0 or e % args.eval_every == 0:
             for encoder in encoders:
-                encoder.zero_grad()
-
-            outs = []
-            if args.mixup_scale > 0:
-                perm_idx, lam, elem = datahandler.mixup(elem, scale=args.mixup_scale)
-            for it, dtype in enumerate(args.contrastive):
-                outs.append(encoders[it](elem[dtype]))
-            if args.mixup_scale > 0:
-                l = info_nce(outs, distance=distance, twoway=True, lam=lam, perm_idx=perm_idx, temperature=args.temp)
-            else:
-                l = info_nce(outs, distance=distance, twoway=args.twoway, fourway=args.fourway, lr_weight=args.lr_weight, temperature=args.temp)
+                encoder.train()
+            if distributed:
+                dist.barrier()
+
+        if (e % args.save_every == 0 or (distributed and e == args.epochs)) and is_main:
+            # the host buffers are reused, so the previous save must be done with them
+            saves[-1].result()
+            states = {name: cpu_state_dict(encoder, states[name]) for encoder, name in zip(encoders, args.contrastive)}
+            current_args = json.dumps(data_args, sort_keys=True)
+            changed = current_args != saved_args
+            saved_args = current_args
+            # the saver gets a snapshot of the args, not the live dict
+            saves.append(saver.submit(save_checkpoint, args.path_dir, e, states, dict(data_args) if changed else None))
+            pwint("[saved]")
 
-            saved_loss.append(l.detach().item())
-            for it, out in enumerate(outs):
-                saved_vars[it].append(torch.mean(torch.std(out, dim=0)).detach())
+    pbar.close()
+    # wait for the last writes, and surface any that failed
+    saver.shutdown(wait=True)
+    for save in saves:
+        save.result()
 
-            l.backward()
-            for encoder in encoders:
-                if args.clip != -1:
-                    torch.nn.utils.clip_grad_norm_(encoder.parameters(), args.clip)
-            for optimizer in optimizers:
-                optimizer.step()
-            for lr_scheduler in lr_schedulers:
-                lr_scheduler.step()
-            torch.cuda.empty_cache()
-
-        if e % args.val_every == 0:
-            evaluate_single(args, encoders, datahandler, e, tasks=[])
-
-        if e % args.eval_every == 0:
-            evaluate_single(args, encoders, datahandler, e, expensive=True)
-
-        if e % args.save_every == 0:
-            for encoder, name in zip(encoders, args.contrastive):
-                torch.save(dict(epoch=0, state_dict=encoder.state_dict()), os.path.join(args.path_dir, f'{e}-{name}.pth'))
-
-            with open(os.path.join(args.path_dir, f'{e}.args'), 'w') as fp:
-                json.dump(data_args, fp, indent=4)
-            pwint("[saved]")
+    if is_main:
+        write_all(args, eval_encoders, datahandler)
 
-    write_all(args, encoders, datahandler)
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
 
-    if verbose:
+    if verbose and is_main:
         pwint("[Pretraining] Training complete")
 
     return encoders
@@ -887,7 +1147,7 @@ def evaluate(args, encoders, datahandler):
     return ft_encoders
 
 def main(args):
-    global verbose, log_file
+    global verbose, log_file, _uni_info_nce, _all_pairs_info_nce
 
     if args.verbose:
         verbose = True
@@ -922,12 +1182,12 @@ def main(args):
 
     if args.eval_epoch == -1:
         try:
-            args.eval_epoch = most_recent_file(args.path_dir, "args")
+            args.eval_epoch = most_recent_file(args.path_dir, (".args", ".epoch"))
             args.eval_epoch = int(args.eval_epoch[args.eval_epoch.rfind("/") + 1:args.eval_epoch.rfind(".")])
         except:
             args.eval_epoch = -1
 
-    has_saved = os.path.isfile(os.path.join(args.path_dir, f"{args.eval_epoch}.args")) 
+    has_saved = os.path.isfile(os.path.join(args.path_dir, f"{args.eval_epoch}.args")) or os.path.isfile(os.path.join(args.path_dir, f"{args.eval_epoch}.epoch"))
     new_weights = args.new_weights or (not has_saved)
 
     if new_weights:
@@ -958,7 +1218,7 @@ def main(args):
             with open(os.path.join(args.path_dir, 'dataset/datahandler.pt'), 'rb') as f:
                 datahandler = pickle.load(f)
             
-            with open(os.path.join(args.path_dir, str(args.eval_epoch) + ".args"), "r") as f:
+            with open(saved_args_path(args.path_dir, args.eval_epoch), "r") as f:
                 old_args = json.load(f)
 
             args.contrastive = datahandler.contrastive
@@ -967,15 +1227,7 @@ def main(args):
 
             encoders = model.TCGAEncoders(data_types=old_args["contrastive"], datahandler=datahandler, mode=args.mode, rep_dim=old_args["repr_dim"], rna_hidden=old_args["rna_hidden"], trns_arch=old_args["lm_arch"], clin_arch=old_args["clin_arch"], clin_hidden=old_args["clin_hidden"], cheads=old_args["cheads"], cdepth=old_args["cdepth"], cdropout=old_args["cdropout"], nocombine=old_args["nocombine"], inter_attn=old_args["inter_attn"], cdims=old_args["cdims"])
             for encoder, name in zip(encoders, args.contrastive): # TODO REMOVE THIS
-                try:
-                    encoder.load_state_dict(torch.load(os.path.join(args.path_dir, str(args.eval_epoch) + "-" + name + ".pth"))["state_dict"])
-                except:
-                    sdict = torch.load(os.path.join(args.path_dir, str(args.eval_epoch) + "-" + name + ".pth"))["state_dict"]
-                    for key in list(sdict.keys()):
-                        if key.startswith("module."):
-                            sdict[key[7:]] = sdict[key]
-                            del sdict[key]
-                    encoder.load_state_dict(sdict)
+                load_encoder_state(encoder, os.path.join(args.path_dir, str(args.eval_epoch) + "-" + name + ".pth"))
         else:
             datahandler = datasets.TCGADataHandler(contrastive=args.contrastive, zero_shot=args.zero_shot, finetune=args.finetune, train_ratio=args.train_ratio, ft_train_ratio=args.ft_train_ratio, lg_types=args.lg_types, rna_thresh=args.rna_thresh, clin_thresh=args.clin_thresh, rna_set=args.rna_set, rand_shuffle=args.rand_shuffle, lm_arch=args.lm_arch, clin_one_hot=(args.clin_arch == 'mlp'))
             encoders = model.TCGAEncoders(data_types=args.contrastive, datahandler=datahandler, mode=args.mode, rep_dim=args.repr_dim, rna_hidden=args.rna_hidden, trns_arch=args.lm_arch, clin_arch=args.clin_arch, clin_hidden=args.clin_hidden, cheads=args.cheads, cdepth=args.cdepth, cdropout=args.cdropout, nocombine=args.nocombine, inter_attn=args.inter_attn, cdims=args.cdims)
@@ -985,10 +1237,18 @@ def main(args):
             except:
                 pass
 
-            torch.save(datahandler, os.path.join(args.path_dir, "dataset/datahandler.pt"))
             with open(os.path.join(args.path_dir, "dataset/datahandler.pt"), 'wb') as f:
                 pickle.dump(datahandler, f, protocol=pickle.HIGHEST_PROTOCOL)
     
+    # multi-gpu pretraining compiles the losses inside each spawned worker instead
+    if args.compile and not ("pretraining" in args.mode and "," in args.gpu):
+        # Module.compile works in place, so isinstance checks and state_dict keys are unchanged.
+        # pretraining compiles its encoders itself
+        if "pretraining" not in args.mode:
+            for encoder in ([encoder] if "validate" in args.mode else encoders):
+                encoder.compile(mode='reduce-overhead')
+        _uni_info_nce = torch.compile(_uni_info_nce, dynamic=True)
+        _all_pairs_info_nce = torch.compile(_all_pairs_info_nce, dynamic=True)
 
     try:
         if "validate" in args.mode:
@@ -1000,10 +1260,9 @@ def main(args):
     except Exception:
         pwint(traceback.format_exc())
 
-    if not args.silent:
-        for i in range(0,15):
-            subprocess.run("echo $\'\a\'", shell=True)
-            time.sleep(3)
+    # no bell when output goes to a file (sweeps, nohup)
+    if not args.silent and sys.stdout.isatty():
+        print('\a' * 15, flush=True)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
@@ -1087,6 +1346,7 @@ if __name__ == '__main__':
     parser.add_argument('--ft_trials', default=20, type=int)
 
     parser.add_argument('--bsz', default=512, type=int)
+    parser.add_argument('--accum_steps', default=1, type=int) # micro-batches per optimizer step
     parser.add_argument('--val_bsz', default=16, type=int)
     parser.add_argument('--manual', default='(brca)', type=str)
     parser.add_argument('--type_bsz', default=32, type=int)
@@ -1095,6 +1355,10 @@ if __name__ == '__main__':
     parser.add_argument('--warmup_epochs', default=5, type=int)
 
     parser.add_argument('--rand_shuffle', default=False, action='store_true')
+    parser.add_argument('--compile', default=False, action='store_true') # torch.compile encoders and infoNCE
+    parser.add_argument('--dist_timeout', default=360, type=int) # minutes a ddp rank may wait on rank 0's evaluations
+    parser.add_argument('--amp', default=True, action=argparse.BooleanOptionalAction) # autocast in pretraining, --no-amp for fp32
+    parser.add_argument('--amp_dtype', default='bf16', choices=['bf16', 'fp16'], type=str) # fp16 adds loss scaling
     parser.add_argument('--site_batch', default=1, type=int)
 
     parser.add_argument('--l_lr', default="(2e-5,0.001)", type=str) # learning rate for bert
@@ -1118,4 +1382,6 @@ if __name__ == '__main__':
     parser.add_argument('--repr_dim', default=32, type=int)
 
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error("--accum_steps must be at least 1")
     main(args)